@@ -9,14 +9,18 @@ import json
 import time
 import sqlite3
 import threading
-import statistics
+import queue
+import re
+import math
+import bisect
+from collections import deque
 from datetime import datetime, timedelta
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional, Any
+from typing import Deque, Dict, List, Optional, Any
 from enum import Enum
 from pathlib import Path
 
-import pandas as pd
+import orjson
 import numpy as np
 from rich.console import Console
 from rich.table import Table
@@ -27,6 +31,19 @@ from rich.layout import Layout
 
 console = Console()
 
+# センサーデータのINSERT文（書き込みスレッドで使い回す）
+_INSERT_SENSOR_SQL = (
+    "INSERT INTO sensor_data (machine_id, sensor_type, value, unit, quality, timestamp) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+# 処理対象トピックのルーティング（1回のマッチで種別とIDを抽出）
+# groups: (scope, name, line_id, machine_id, sensor_type, kind)
+_TOPIC_RE = re.compile(
+    r"factory/(?:(alerts|production)/([^/]+)"
+    r"|([^/]+)/([^/]+)/(?:sensors/([^/]+)|(status|commands|maintenance)))"
+)
+
 class AlertLevel(Enum):
     INFO = "info"
     WARNING = "warning"
@@ -49,16 +66,126 @@ class SensorData:
     timestamp: datetime
     quality: float = 1.0  # データ品質 0-1
 
+class SensorSeries:
+    """機器・センサーごとの時系列データ（NumPy配列による構造体配列形式のリングバッファ）
+    
+    値・タイムスタンプ（エポックns）・品質を並列配列で保持し、SensorDataオブジェクトは保持しない。
+    直近window件の線形回帰に必要な Σy, Σxy と、平均・分散（Welford法）を
+    追加のたびにO(1)で更新する。xはウィンドウ先頭からのインデックス（0..window-1）。
+    """
+    
+    def __init__(self, capacity: int = 1000, window: int = 100):
+        self.capacity = capacity
+        self.window = window
+        # 同じ値を2箇所に書き込むことで、直近n件を常に連続したビューとして取り出せる
+        self.values = np.empty(capacity * 2, dtype=np.float32)
+        self.timestamps = np.empty(capacity * 2, dtype=np.int64)
+        self.quality = np.empty(capacity * 2, dtype=np.float32)
+        self.idx = 0
+        self.len = 0
+        
+        # 直近window件の累積和
+        self.sum_y = 0.0
+        self.sum_xy = 0.0
+        # 直近window件の平均と偏差平方和（Welford法）
+        self.mean = 0.0
+        self.m2 = 0.0
+        self._pushes = 0
+    
+    def __len__(self) -> int:
+        return self.len
+    
+    def append(self, value: float, timestamp_ns: int, quality: float = 1.0):
+        k = min(self.len, self.window)
+        y_old = float(self.values[self.idx + self.capacity - k]) if k == self.window else 0.0
+        
+        i, j = self.idx, self.idx + self.capacity
+        self.values[i] = self.values[j] = value
+        self.timestamps[i] = self.timestamps[j] = timestamp_ns
+        self.quality[i] = self.quality[j] = quality
+        y_new = float(self.values[i])  # float32に丸めた値で累積する
+        self.idx = (self.idx + 1) % self.capacity
+        if self.len < self.capacity:
+            self.len += 1
+        
+        if k < self.window:
+            # ウィンドウが埋まるまでは末尾(x=k)に追加するだけ
+            self.sum_xy += k * y_new
+            self.sum_y += y_new
+            
+            delta = y_new - self.mean
+            self.mean += delta / (k + 1)
+            self.m2 += delta * (y_new - self.mean)
+        else:
+            # 先頭(x=0)を除き、残りのxを1つずつ左にずらしてから末尾に追加
+            self.sum_xy += -(self.sum_y - y_old) + (k - 1) * y_new
+            self.sum_y += y_new - y_old
+            
+            # 件数一定のまま y_old を y_new に置き換える
+            old_mean = self.mean
+            self.mean += (y_new - y_old) / k
+            self.m2 += (y_new - y_old) * (y_new - self.mean + y_old - old_mean)
+        
+        # 浮動小数点誤差の蓄積を防ぐため定期的に厳密値で再計算
+        # inf/NaNが混入した場合も、そのサンプルがウィンドウから外れた時点で回復できるよう再計算する
+        self._pushes += 1
+        if (self._pushes % self.capacity == 0
+                or not (math.isfinite(self.sum_y) and math.isfinite(self.sum_xy) and math.isfinite(self.m2))):
+            self._resync()
+    
+    def _resync(self):
+        """直近window件から累積値を厳密に再計算"""
+        window = self.last(self.window).astype(np.float64)
+        self.sum_y = float(window.sum())
+        self.sum_xy = float(np.dot(np.arange(len(window)), window))
+        self.mean = float(window.mean())
+        self.m2 = float(np.dot(window - self.mean, window - self.mean))
+    
+    def std(self) -> float:
+        """直近window件の標本標準偏差"""
+        n = min(self.len, self.window)
+        if n < 2:
+            return 0.0
+        return math.sqrt(max(self.m2, 0.0) / (n - 1))
+    
+    def _tail(self, arr: np.ndarray, n: int) -> np.ndarray:
+        n = min(n, self.len)
+        end = self.idx + self.capacity
+        return arr[end - n:end]
+    
+    def last(self, n: int) -> np.ndarray:
+        """直近n件の値を古い順に返す（コピーなしのビュー）"""
+        return self._tail(self.values, n)
+    
+    def last_timestamps(self, n: int) -> np.ndarray:
+        """直近n件のタイムスタンプ（エポックns）を古い順に返す"""
+        return self._tail(self.timestamps, n)
+    
+    def last_quality(self, n: int) -> np.ndarray:
+        """直近n件の品質を古い順に返す"""
+        return self._tail(self.quality, n)
+
 @dataclass
 class Machine:
     machine_id: str
     machine_type: str
     line_id: str
+    machine_name: str  # ライン内の機器名（トピック用）
     status: MachineStatus = MachineStatus.OFFLINE
     last_seen: Optional[datetime] = None
-    sensor_data: Dict[str, List[SensorData]] = field(default_factory=dict)
-    alerts: List[Dict[str, Any]] = field(default_factory=list)
+    sensor_data: Dict[str, SensorSeries] = field(default_factory=dict)
+    alerts: Deque[Dict[str, Any]] = field(default_factory=lambda: deque(maxlen=100))  # 最新100件のみ保持
     performance_metrics: Dict[str, float] = field(default_factory=dict)
+    # last_seenの表示用文字列（last_seenが変わったときだけ再フォーマット）
+    _last_seen_str: str = field(default="Never", init=False, repr=False)
+    _last_seen_str_src: Optional[datetime] = field(default=None, init=False, repr=False)
+    
+    @property
+    def last_seen_str(self) -> str:
+        if self.last_seen is not self._last_seen_str_src:
+            self._last_seen_str_src = self.last_seen
+            self._last_seen_str = self.last_seen.strftime("%H:%M:%S") if self.last_seen else "Never"
+        return self._last_seen_str
 
 class IndustrialIoTMonitor:
     """産業用IoTモニタリングシステム"""
@@ -71,6 +198,21 @@ class IndustrialIoTMonitor:
         self.db_path = "industrial_iot.db"
         self.init_database()
         
+        # センサーデータ書き込みキュー（バックグラウンドでまとめてINSERT）
+        self._write_queue: "queue.Queue[tuple]" = queue.Queue(maxsize=10000)
+        self.write_batch_size = 500
+        self.write_batch_timeout = 0.05  # 秒
+        self.min_persist_quality = 0.5  # これ未満の品質のデータはDBに保存しない
+        
+        # 受信キュー（Pahoのネットワークスレッドから処理を切り離す）
+        # 同じ機器のメッセージは常に同じワーカーで順番に処理されるよう機器ごとに振り分ける
+        self.num_workers = 2
+        self._rx_queues: List["queue.Queue[tuple]"] = [
+            queue.Queue(maxsize=50000 // self.num_workers) for _ in range(self.num_workers)
+        ]
+        # 全ワーカーが受信キューを処理し終えたら書き込みスレッドに終了を知らせる
+        self._consumers_done = threading.Event()
+        
         # 機器管理
         self.machines: Dict[str, Machine] = {}
         self.production_lines: Dict[str, List[str]] = {
@@ -86,31 +228,75 @@ class IndustrialIoTMonitor:
             "pressure": {"warning": 150.0, "critical": 200.0},
             "current": {"warning": 80.0, "critical": 100.0}
         }
+        # 判定用に (warning, critical, 表示名) を事前計算
+        self._thresh = {
+            k: (v["warning"], v["critical"], k.title())
+            for k, v in self.alert_thresholds.items()
+        }
         
         # 統計データ
         self.stats = {
             "messages_processed": 0,
             "alerts_generated": 0,
             "machines_online": 0,
-            "total_downtime": 0
+            "total_downtime": 0,
+            "db_writes_dropped": 0,
+            "publishes_dropped": 0,
+            "rx_dropped": 0
         }
         
+        # ダッシュボード描画キャッシュ（状態変化があったときだけ再構築）
+        self._dirty = {"machines": True, "alerts": True}
+        self._cached_machine_table: Optional[Table] = None
+        self._cached_alerts_table: Optional[Table] = None
+        self._machine_order: List[str] = []  # machine_idでソート済み
+        self._machines_lock = threading.Lock()  # 機器の新規登録用
+        self._recent_alerts: Deque[Dict[str, Any]] = deque(maxlen=10)  # 全機器の最新アラート（新しい順）
+        
+        # アラート配信バッファ（一定時間内のアラートを1メッセージにまとめて送信）
+        self.alert_batch_window = 0.1  # 秒
+        self._alert_pub_buf: List[Dict[str, Any]] = []
+        self._alert_pub_lock = threading.Lock()
+        self._alert_pub_timer: Optional[threading.Timer] = None
+        
         # MQTT設定
         self.client = mqtt.Client(client_id="industrial_monitor")
+        # 送信側の上限を明示（アラート多発時のメモリ増加を防ぎ、QoS 1の同時送信数を確保）
+        self.client.max_inflight_messages_set(100)
+        self.client.max_queued_messages_set(10000)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
         
         self.connected = threading.Event()
         
+        # 機器メッセージの種別ごとのハンドラ
+        self._dispatch = {
+            "status": self.handle_status_update,
+            "commands": self.handle_command,
+            "maintenance": self.handle_maintenance_data
+        }
+        
         # バックグラウンドタスク
         self.running = True
         self.start_background_tasks()
     
     def init_database(self):
         """データベースの初期化"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        # 長寿命の接続を1本だけ保持し、ロックで書き込みを直列化する
+        # (isolation_level=None: 自動コミットモード。明示的なBEGIN/COMMITも可能)
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._db_lock = threading.Lock()
+        
+        with self._db_lock:
+            cursor = self._db.cursor()
+            
+            # WALモード: 書き込みが読み込みをブロックせず、INSERTごとのfsyncを削減
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+            cursor.execute("PRAGMA cache_size=-64000")  # 約64MBのページキャッシュ
+            cursor.execute("PRAGMA busy_timeout=5000")
             
             # センサーデータテーブル
             cursor.execute('''
@@ -152,7 +338,13 @@ class IndustrialIoTMonitor:
                 )
             ''')
             
-            conn.commit()
+            # インデックス（古いデータ削除と機器・センサー別の検索用）
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_sensor_ts ON sensor_data(timestamp)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_alerts_created ON alerts(created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_sensor_mid_type ON sensor_data(machine_id, sensor_type)")
+        
+        # 書き込みスレッド専用のカーソル（同じINSERT文を使い回し、SQLの再パースを避ける）
+        self._ins_sensor = self._db.cursor()
     
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
@@ -163,7 +355,7 @@ class IndustrialIoTMonitor:
             topics = [
                 ("factory/+/+/sensors/+", 0),      # センサーデータ
                 ("factory/+/+/status", 1),         # 機器状態
-                ("factory/+/+/commands", 2),       # 制御コマンド
+                ("factory/+/+/commands", 1),       # 制御コマンド
                 ("factory/+/+/maintenance", 1),    # 保全情報
                 ("factory/alerts/+", 1),           # アラート
                 ("factory/production/+", 0)        # 生産データ
@@ -176,79 +368,125 @@ class IndustrialIoTMonitor:
             console.print(f"❌ Connection failed: {rc}", style="red")
     
     def on_message(self, client, userdata, msg):
+        """メッセージ受信（処理はワーカースレッドに委譲）"""
+        # 対象外のトピックはキューに積まずに破棄
+        # 停止処理中は新しいメッセージを受け付けない（受信済みの分だけ処理して終了する）
+        if not self.running:
+            return
+        
+        match = _TOPIC_RE.fullmatch(msg.topic)
+        if match is None:
+            return
+        
+        self.stats["messages_processed"] += 1
+        
+        # (line_id, machine_id) でワーカーを選択
+        rx_q = self._rx_queues[hash(match.group(3, 4)) % self.num_workers]
+        item = (match, msg.payload, time.time())
+        try:
+            rx_q.put_nowait(item)
+        except queue.Full:
+            # バースト時は古いメッセージを捨てて遅延を抑える
+            try:
+                rx_q.get_nowait()
+            except queue.Empty:
+                pass
+            self.stats["rx_dropped"] += 1
+            try:
+                rx_q.put_nowait(item)
+            except queue.Full:
+                pass
+    
+    def _consume(self, rx_q: "queue.Queue[tuple]"):
+        """受信キューからメッセージを取り出して処理"""
+        while self.running or not rx_q.empty():
+            try:
+                match, payload, recv_time = rx_q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.process_message(match, payload, recv_time)
+    
+    def process_message(self, match: "re.Match[str]", raw_payload: bytes, recv_time: float):
         """メッセージ処理"""
         try:
-            self.stats["messages_processed"] += 1
+            now = datetime.fromtimestamp(recv_time)
             
-            topic_parts = msg.topic.split('/')
-            payload = json.loads(msg.payload.decode())
+            payload = orjson.loads(raw_payload)  # bytesを直接パース（decode不要）
+            scope, name, line_id, machine_id, sensor_type, kind = match.groups()
             
-            if len(topic_parts) >= 4:
-                _, line_id, machine_id, message_type = topic_parts[:4]
-                
-                # メッセージタイプ別処理
-                if message_type == "sensors":
-                    self.handle_sensor_data(line_id, machine_id, topic_parts[4], payload)
-                elif message_type == "status":
-                    self.handle_status_update(line_id, machine_id, payload)
-                elif message_type == "commands":
-                    self.handle_command(line_id, machine_id, payload)
-                elif message_type == "maintenance":
-                    self.handle_maintenance_data(line_id, machine_id, payload)
-                
-            elif msg.topic.startswith("factory/alerts/"):
-                self.handle_factory_alert(topic_parts[2], payload)
-            elif msg.topic.startswith("factory/production/"):
-                self.handle_production_data(topic_parts[2], payload)
+            # メッセージタイプ別処理
+            if sensor_type is not None:
+                self.handle_sensor_data(line_id, machine_id, sensor_type, payload, now)
+            elif kind is not None:
+                self._dispatch[kind](line_id, machine_id, payload)
+            elif scope == "alerts":
+                self.handle_factory_alert(name, payload)
+            else:
+                self.handle_production_data(name, payload)
                 
-        except json.JSONDecodeError:
-            console.print(f"⚠️  Invalid JSON: {msg.topic}", style="yellow")
+        except orjson.JSONDecodeError:
+            console.print(f"⚠️  Invalid JSON: {match.string}", style="yellow")
         except Exception as e:
             console.print(f"❌ Message processing error: {e}", style="red")
     
-    def handle_sensor_data(self, line_id: str, machine_id: str, sensor_type: str, payload: Dict[str, Any]):
+    def handle_sensor_data(self, line_id: str, machine_id: str, sensor_type: str, payload: Dict[str, Any],
+                           now: Optional[datetime] = None):
         """センサーデータの処理"""
         try:
+            if now is None:
+                now = datetime.now()
+            
             # 機器情報を取得または作成
             full_machine_id = f"{line_id}_{machine_id}"
             if full_machine_id not in self.machines:
-                self.machines[full_machine_id] = Machine(
-                    machine_id=full_machine_id,
-                    machine_type=payload.get("machine_type", "unknown"),
-                    line_id=line_id
-                )
-                
-                # 生産ラインに追加
-                if line_id in self.production_lines:
-                    if full_machine_id not in self.production_lines[line_id]:
-                        self.production_lines[line_id].append(full_machine_id)
+                with self._machines_lock:
+                    self.machines[full_machine_id] = Machine(
+                        machine_id=full_machine_id,
+                        machine_type=payload.get("machine_type", "unknown"),
+                        line_id=line_id,
+                        machine_name=machine_id
+                    )
+                    bisect.insort(self._machine_order, full_machine_id)
+                    
+                    # 生産ラインに追加
+                    if line_id in self.production_lines:
+                        if full_machine_id not in self.production_lines[line_id]:
+                            self.production_lines[line_id].append(full_machine_id)
             
             machine = self.machines[full_machine_id]
-            machine.last_seen = datetime.now()
+            machine.last_seen = now
             machine.status = MachineStatus.RUNNING
+            self._dirty["machines"] = True
             
-            # センサーデータを作成
+            # センサーデータを作成（timestampがない場合は受信時刻を使用）
+            # SensorDataはパースから保存までの一時オブジェクトで、機器の状態には保持しない
+            ts_raw = payload.get("timestamp")
             sensor_data = SensorData(
                 machine_id=full_machine_id,
                 sensor_type=sensor_type,
                 value=float(payload.get("value", 0)),
-                unit=payload.get("unit", ""),
-                timestamp=datetime.fromisoformat(payload.get("timestamp", datetime.now().isoformat())),
+                unit=payload.get("unit") or "",
+                timestamp=datetime.fromisoformat(ts_raw) if ts_raw else now,
                 quality=float(payload.get("quality", 1.0))
             )
             
-            # データを保存
-            if sensor_type not in machine.sensor_data:
-                machine.sensor_data[sensor_type] = []
-            
-            machine.sensor_data[sensor_type].append(sensor_data)
+            # 時系列バッファに追加（最新1000件のみ保持）
+            series = machine.sensor_data.get(sensor_type)
+            if series is None:
+                series = machine.sensor_data[sensor_type] = SensorSeries(1000, window=100)
             
-            # 最新1000件のみ保持
-            if len(machine.sensor_data[sensor_type]) > 1000:
-                machine.sensor_data[sensor_type] = machine.sensor_data[sensor_type][-1000:]
+            series.append(
+                sensor_data.value,
+                int(sensor_data.timestamp.timestamp() * 1_000_000_000),
+                sensor_data.quality
+            )
             
-            # データベースに保存
-            self.save_sensor_data_to_db(sensor_data)
+            # データベースに保存（低品質データはメモリ上の統計・異常検知にのみ使用）
+            if sensor_data.quality >= self.min_persist_quality:
+                self.save_sensor_data_to_db(
+                    full_machine_id, sensor_type, sensor_data.value,
+                    sensor_data.unit, sensor_data.quality, sensor_data.timestamp
+                )
             
             # 異常検知
             self.check_sensor_alerts(machine, sensor_data)
@@ -271,6 +509,7 @@ class IndustrialIoTMonitor:
                 new_status = MachineStatus(payload.get("status", "offline"))
                 machine.status = new_status
                 machine.last_seen = datetime.now()
+                self._dirty["machines"] = True
                 
                 # 状態変更をログ
                 if old_status != new_status:
@@ -300,9 +539,9 @@ class IndustrialIoTMonitor:
         
         # コマンド実行のシミュレート
         if command == "start":
-            self.send_machine_command(full_machine_id, "start_production")
+            self.send_machine_command(line_id, machine_id, "start_production")
         elif command == "stop":
-            self.send_machine_command(full_machine_id, "stop_production")
+            self.send_machine_command(line_id, machine_id, "stop_production")
         elif command == "maintenance":
             self.schedule_maintenance(full_machine_id, payload.get("maintenance_type"))
         elif command == "reset_alerts":
@@ -318,6 +557,7 @@ class IndustrialIoTMonitor:
         if full_machine_id in self.machines:
             machine = self.machines[full_machine_id]
             machine.status = MachineStatus.MAINTENANCE
+            self._dirty["machines"] = True
             
             # 保全情報をアラートとして記録
             self.generate_alert(
@@ -328,30 +568,35 @@ class IndustrialIoTMonitor:
     
     def check_sensor_alerts(self, machine: Machine, sensor_data: SensorData):
         """センサーアラートチェック"""
-        sensor_type = sensor_data.sensor_type
+        t = self._thresh.get(sensor_data.sensor_type)
+        if t is None:
+            return
+        
+        warning, critical, title = t
         value = sensor_data.value
         
-        if sensor_type in self.alert_thresholds:
-            thresholds = self.alert_thresholds[sensor_type]
-            
-            if value >= thresholds["critical"]:
-                self.generate_alert(
-                    machine.machine_id,
-                    AlertLevel.CRITICAL,
-                    f"{sensor_type.title()} critical: {value} {sensor_data.unit}",
-                    sensor_type=sensor_type,
-                    value=value,
-                    threshold=thresholds["critical"]
-                )
-            elif value >= thresholds["warning"]:
-                self.generate_alert(
-                    machine.machine_id,
-                    AlertLevel.WARNING,
-                    f"{sensor_type.title()} high: {value} {sensor_data.unit}",
-                    sensor_type=sensor_type,
-                    value=value,
-                    threshold=thresholds["warning"]
-                )
+        # 大半を占める「アラートなし」の場合は文字列を生成せずに戻る
+        if not value >= warning:  # NaNもここで除外される
+            return
+        
+        if value >= critical:
+            self.generate_alert(
+                machine.machine_id,
+                AlertLevel.CRITICAL,
+                f"{title} critical: {value} {sensor_data.unit}",
+                sensor_type=sensor_data.sensor_type,
+                value=value,
+                threshold=critical
+            )
+        else:
+            self.generate_alert(
+                machine.machine_id,
+                AlertLevel.WARNING,
+                f"{title} high: {value} {sensor_data.unit}",
+                sensor_type=sensor_data.sensor_type,
+                value=value,
+                threshold=warning
+            )
     
     def generate_alert(self, machine_id: str, level: AlertLevel, message: str,
                       sensor_type: Optional[str] = None, value: Optional[float] = None,
@@ -371,10 +616,9 @@ class IndustrialIoTMonitor:
         # 機器のアラートリストに追加
         if machine_id in self.machines:
             self.machines[machine_id].alerts.append(alert)
-            
-            # 最新100件のみ保持
-            if len(self.machines[machine_id].alerts) > 100:
-                self.machines[machine_id].alerts = self.machines[machine_id].alerts[-100:]
+            self._dirty["machines"] = True  # アラート件数の表示を更新
+        self._recent_alerts.appendleft(alert)
+        self._dirty["alerts"] = True
         
         # データベースに保存
         self.save_alert_to_db(alert)
@@ -403,76 +647,115 @@ class IndustrialIoTMonitor:
             "auto_generated": True
         }
         
-        line_parts = machine_id.split('_')
-        if len(line_parts) >= 2:
-            line_id, machine_name = line_parts[0], '_'.join(line_parts[1:])
-            topic = f"factory/{line_id}/{machine_name}/emergency"
-            
-            self.client.publish(topic, json.dumps(emergency_command), qos=2)
-            console.print(f"🛑 Emergency stop sent to {machine_id}", style="bold red")
+        machine = self.machines.get(machine_id)
+        if machine is None:
+            return
+        
+        topic = f"factory/{machine.line_id}/{machine.machine_name}/emergency"
+        
+        # emergency_stopは冪等なので重複配信を許容しQoS 1で送信
+        self._publish(topic, json.dumps(emergency_command), qos=1)
+        console.print(f"🛑 Emergency stop sent to {machine_id}", style="bold red")
     
     def calculate_performance_metrics(self, machine: Machine, sensor_type: str):
         """性能指標の計算"""
-        if sensor_type not in machine.sensor_data:
+        series = machine.sensor_data.get(sensor_type)
+        if series is None:
             return
         
-        recent_data = machine.sensor_data[sensor_type][-100:]  # 最新100件
+        window = series.last(series.window)  # 最新100件
         
-        if len(recent_data) >= 10:
-            values = [d.value for d in recent_data]
-            
-            # 統計値を計算
+        if len(window) >= 10:
+            # 平均・標準偏差は逐次更新済みの値を使い、最小・最大のみNumPyで計算
             machine.performance_metrics.update({
-                f"{sensor_type}_mean": statistics.mean(values),
-                f"{sensor_type}_std": statistics.stdev(values) if len(values) > 1 else 0,
-                f"{sensor_type}_min": min(values),
-                f"{sensor_type}_max": max(values),
-                f"{sensor_type}_trend": self.calculate_trend(values)
+                f"{sensor_type}_mean": series.mean,
+                f"{sensor_type}_std": series.std(),
+                f"{sensor_type}_min": float(window.min()),
+                f"{sensor_type}_max": float(window.max()),
+                f"{sensor_type}_trend": self.calculate_trend(series)
             })
     
-    def calculate_trend(self, values: List[float]) -> float:
-        """トレンド計算（線形回帰の傾き）"""
-        if len(values) < 2:
+    def calculate_trend(self, series: SensorSeries) -> float:
+        """トレンド計算（線形回帰の傾き、累積和による閉形式）"""
+        n = min(len(series), series.window)
+        if n < 2:
             return 0.0
         
-        x = list(range(len(values)))
-        n = len(values)
+        sum_x = n * (n - 1) / 2
+        sum_x2 = n * (n - 1) * (2 * n - 1) / 6
         
-        x_mean = sum(x) / n
-        y_mean = sum(values) / n
-        
-        numerator = sum((x[i] - x_mean) * (values[i] - y_mean) for i in range(n))
-        denominator = sum((x[i] - x_mean) ** 2 for i in range(n))
+        numerator = n * series.sum_xy - sum_x * series.sum_y
+        denominator = n * sum_x2 - sum_x ** 2
         
         return numerator / denominator if denominator != 0 else 0.0
     
-    def save_sensor_data_to_db(self, sensor_data: SensorData):
-        """センサーデータをデータベースに保存"""
+    def save_sensor_data_to_db(self, machine_id: str, sensor_type: str, value: float,
+                               unit: str, quality: float, timestamp: datetime):
+        """センサーデータを書き込みキューに追加（実際のINSERTは_writer_loopで実行）"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO sensor_data 
-                    (machine_id, sensor_type, value, unit, quality, timestamp)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (
-                    sensor_data.machine_id,
-                    sensor_data.sensor_type,
-                    sensor_data.value,
-                    sensor_data.unit,
-                    sensor_data.quality,
-                    sensor_data.timestamp.isoformat()
-                ))
-                conn.commit()
+            # NOT NULL制約に違反する行がバッチ全体を巻き込まないよう、キュー投入前に正規化
+            self._write_queue.put_nowait((
+                machine_id, sensor_type, value, "" if unit is None else str(unit), quality,
+                timestamp.isoformat()
+            ))
+        except queue.Full:
+            self.stats["db_writes_dropped"] += 1
+    
+    def _writer_loop(self):
+        """書き込みキューを取り出し、1トランザクションでまとめてINSERT"""
+        while not self._consumers_done.is_set() or not self._write_queue.empty():
+            try:
+                rows = [self._write_queue.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            
+            # バッチサイズに達するか、タイムアウトするまで追加で取り出す
+            deadline = time.monotonic() + self.write_batch_timeout
+            while len(rows) < self.write_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self._write_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            self.flush_sensor_rows(rows)
+    
+    def flush_sensor_rows(self, rows: List[tuple]):
+        """センサーデータをまとめてデータベースに保存"""
+        try:
+            with self._db_lock:
+                self._db.execute("BEGIN")
+                try:
+                    self._ins_sensor.executemany(_INSERT_SENSOR_SQL, rows)
+                    self._db.execute("COMMIT")
+                    return
+                except Exception as e:
+                    self._db.execute("ROLLBACK")
+                    console.print(f"❌ DB batch save error, retrying row by row: {e}", style="red")
+                
+                # 不正な行だけを捨て、残りの行は保存する
+                self._db.execute("BEGIN")
+                try:
+                    for row in rows:
+                        try:
+                            self._ins_sensor.execute(_INSERT_SENSOR_SQL, row)
+                        except Exception as e:
+                            self.stats["db_writes_dropped"] += 1
+                            console.print(f"❌ DB save error: {e}", style="red")
+                    self._db.execute("COMMIT")
+                except Exception:
+                    self._db.execute("ROLLBACK")
+                    raise
         except Exception as e:
             console.print(f"❌ DB save error: {e}", style="red")
     
     def save_alert_to_db(self, alert: Dict[str, Any]):
         """アラートをデータベースに保存"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
+            with self._db_lock:
+                self._db.execute('''
                     INSERT INTO alerts 
                     (machine_id, alert_level, message, sensor_type, value, threshold)
                     VALUES (?, ?, ?, ?, ?, ?)
@@ -484,26 +767,30 @@ class IndustrialIoTMonitor:
                     alert["value"],
                     alert["threshold"]
                 ))
-                conn.commit()
         except Exception as e:
             console.print(f"❌ Alert save error: {e}", style="red")
     
     def save_status_change_to_db(self, machine_id: str, status: str):
         """状態変更をデータベースに保存"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
+            with self._db_lock:
+                self._db.execute('''
                     INSERT INTO machine_status_history (machine_id, status)
                     VALUES (?, ?)
                 ''', (machine_id, status))
-                conn.commit()
         except Exception as e:
             console.print(f"❌ Status save error: {e}", style="red")
     
+    def _publish(self, topic: str, payload, qos: int = 0) -> bool:
+        """MQTT送信（送信キューが満杯の場合は破棄して件数を記録）"""
+        result = self.client.publish(topic, payload, qos=qos)
+        if result.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+            self.stats["publishes_dropped"] += 1
+            return False
+        return True
+    
     def publish_alert(self, alert: Dict[str, Any]):
-        """アラートをMQTTで配信"""
-        topic = f"factory/alerts/{alert['level']}"
+        """アラートを配信バッファに追加（alert_batch_window後にまとめて配信）"""
         payload = {
             "machine_id": alert["machine_id"],
             "level": alert["level"],
@@ -514,22 +801,33 @@ class IndustrialIoTMonitor:
             "threshold": alert["threshold"]
         }
         
-        self.client.publish(topic, json.dumps(payload, default=str), qos=1)
+        with self._alert_pub_lock:
+            self._alert_pub_buf.append(payload)
+            if self._alert_pub_timer is None:
+                self._alert_pub_timer = threading.Timer(self.alert_batch_window, self.flush_alert_publishes)
+                self._alert_pub_timer.daemon = True
+                self._alert_pub_timer.start()
     
-    def send_machine_command(self, machine_id: str, command: str):
-        """機器にコマンドを送信"""
-        line_parts = machine_id.split('_')
-        if len(line_parts) >= 2:
-            line_id, machine_name = line_parts[0], '_'.join(line_parts[1:])
-            topic = f"factory/{line_id}/{machine_name}/commands/response"
-            
-            response = {
-                "command": command,
-                "status": "executed",
-                "timestamp": datetime.now().isoformat()
-            }
-            
-            self.client.publish(topic, json.dumps(response), qos=1)
+    def flush_alert_publishes(self):
+        """バッファ内のアラートをJSON配列として1メッセージで配信"""
+        with self._alert_pub_lock:
+            buffer, self._alert_pub_buf = self._alert_pub_buf, []
+            self._alert_pub_timer = None
+        
+        if buffer:
+            self._publish("factory/alerts/batch", orjson.dumps(buffer), qos=1)
+    
+    def send_machine_command(self, line_id: str, machine_name: str, command: str):
+        """機器にコマンドを送信（未登録の機器にもトピックの値で応答する）"""
+        topic = f"factory/{line_id}/{machine_name}/commands/response"
+        
+        response = {
+            "command": command,
+            "status": "executed",
+            "timestamp": datetime.now().isoformat()
+        }
+        
+        self._publish(topic, json.dumps(response), qos=1)
     
     def get_dashboard_layout(self) -> Layout:
         """ダッシュボードレイアウトを作成"""
@@ -563,6 +861,11 @@ class IndustrialIoTMonitor:
     
     def get_machines_table(self) -> Table:
         """機器状況テーブル"""
+        if not self._dirty["machines"] and self._cached_machine_table is not None:
+            return self._cached_machine_table
+        # 構築中の更新を取りこぼさないよう、先にフラグを下ろす
+        self._dirty["machines"] = False
+        
         table = Table(title="Machine Status")
         table.add_column("Machine ID", style="cyan")
         table.add_column("Line", style="magenta")
@@ -570,7 +873,8 @@ class IndustrialIoTMonitor:
         table.add_column("Last Seen", style="yellow")
         table.add_column("Alerts", style="red")
         
-        for machine in sorted(self.machines.values(), key=lambda m: m.machine_id):
+        for machine_id in self._machine_order:
+            machine = self.machines[machine_id]
             status_style = {
                 MachineStatus.RUNNING: "green",
                 MachineStatus.IDLE: "yellow", 
@@ -579,8 +883,9 @@ class IndustrialIoTMonitor:
                 MachineStatus.OFFLINE: "dim"
             }.get(machine.status, "white")
             
-            last_seen = machine.last_seen.strftime("%H:%M:%S") if machine.last_seen else "Never"
-            alert_count = len([a for a in machine.alerts if not a["acknowledged"]])
+            last_seen = machine.last_seen_str
+            # 他スレッドがアラートを追加してもよいようスナップショットを走査
+            alert_count = sum(1 for a in list(machine.alerts) if not a["acknowledged"])
             alert_text = f"{alert_count} active" if alert_count > 0 else "None"
             
             table.add_row(
@@ -591,32 +896,32 @@ class IndustrialIoTMonitor:
                 alert_text
             )
         
+        self._cached_machine_table = table
         return table
     
     def get_alerts_table(self) -> Table:
         """アラートテーブル"""
+        if not self._dirty["alerts"] and self._cached_alerts_table is not None:
+            return self._cached_alerts_table
+        self._dirty["alerts"] = False
+        
         table = Table(title="Recent Alerts")
         table.add_column("Time", style="blue")
         table.add_column("Machine", style="cyan")
         table.add_column("Level", style="yellow")
         table.add_column("Message", style="white")
         
-        # 全アラートを収集して時刻順にソート
-        all_alerts = []
-        for machine in self.machines.values():
-            for alert in machine.alerts[-5:]:  # 最新5件
-                all_alerts.append(alert)
-        
-        all_alerts.sort(key=lambda a: a["timestamp"], reverse=True)
-        
-        for alert in all_alerts[:10]:  # 最新10件表示
+        for alert in list(self._recent_alerts):  # 最新10件表示
             level_style = {
                 "critical": "bold red",
                 "warning": "yellow",
                 "info": "blue"
             }.get(alert["level"], "white")
             
-            time_str = alert["timestamp"].strftime("%H:%M:%S")
+            # 表示用の時刻文字列はアラートごとに1回だけフォーマット
+            time_str = alert.get("time_str")
+            if time_str is None:
+                time_str = alert["time_str"] = alert["timestamp"].strftime("%H:%M:%S")
             
             table.add_row(
                 time_str,
@@ -625,6 +930,7 @@ class IndustrialIoTMonitor:
                 alert["message"][:50] + "..." if len(alert["message"]) > 50 else alert["message"]
             )
         
+        self._cached_alerts_table = table
         return table
     
     def get_uptime(self) -> str:
@@ -652,6 +958,16 @@ class IndustrialIoTMonitor:
         
         threading.Thread(target=health_check_loop, daemon=True).start()
         threading.Thread(target=cleanup_loop, daemon=True).start()
+        
+        self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer_thread.start()
+        
+        self._consumer_threads = [
+            threading.Thread(target=self._consume, args=(rx_q,), daemon=True)
+            for rx_q in self._rx_queues
+        ]
+        for thread in self._consumer_threads:
+            thread.start()
     
     def perform_health_check(self):
         """機器のヘルスチェック"""
@@ -665,17 +981,18 @@ class IndustrialIoTMonitor:
                 if time_since_last_seen > timedelta(minutes=5):
                     if machine.status != MachineStatus.OFFLINE:
                         machine.status = MachineStatus.OFFLINE
+                        self._dirty["machines"] = True
                         self.generate_alert(
                             machine.machine_id,
                             AlertLevel.WARNING,
-                            f"Machine went offline (last seen: {machine.last_seen.strftime('%H:%M:%S')})"
+                            f"Machine went offline (last seen: {machine.last_seen_str})"
                         )
     
     def cleanup_old_data(self):
         """古いデータのクリーンアップ"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
+            with self._db_lock:
+                cursor = self._db.cursor()
                 
                 # 7日以上古いセンサーデータを削除
                 cutoff_date = (datetime.now() - timedelta(days=7)).isoformat()
@@ -688,9 +1005,6 @@ class IndustrialIoTMonitor:
                 cursor.execute('''
                     DELETE FROM alerts WHERE created_at < ?
                 ''', (cutoff_date,))
-                
-                conn.commit()
-                
         except Exception as e:
             console.print(f"❌ Cleanup error: {e}", style="red")
     
@@ -720,9 +1034,27 @@ class IndustrialIoTMonitor:
     
     def disconnect(self):
         self.running = False
+        
+        # 処理中のメッセージを終えてから後片付け
+        for thread in self._consumer_threads:
+            thread.join(timeout=5)
+        self._consumers_done.set()
+        
+        # 未送信のアラートを配信してから切断
+        with self._alert_pub_lock:
+            timer = self._alert_pub_timer
+        if timer is not None:
+            timer.cancel()
+        self.flush_alert_publishes()
+        
         if self.connected.is_set():
             self.client.loop_stop()
             self.client.disconnect()
+        
+        # キューに残ったセンサーデータを書き込んでから接続を閉じる
+        self._writer_thread.join(timeout=5)
+        with self._db_lock:
+            self._db.close()
 
 def main():
     """メイン実行関数"""
@@ -734,7 +1066,7 @@ def main():
         "• パフォーマンス分析\n"
         "• 自動緊急対応\n\n"
         "Language: Python 3\n"
-        "Libraries: paho-mqtt, pandas, rich",
+        "Libraries: paho-mqtt, numpy, orjson, rich",
         title="Industrial IoT Monitoring System",
         border_style="blue"
     ))
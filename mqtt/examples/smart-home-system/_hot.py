@@ -0,0 +1,45 @@
+"""
+Smart Home System - メッセージ処理のホットパス
+受信メッセージごとに実行される処理を型付きの関数としてまとめたモジュール
+
+そのままPythonとして動作するが、mypycでコンパイルすることもできる:
+    mypyc _hot.py
+コンパイル済みの拡張モジュールがあれば import 時にそちらが優先される。
+"""
+
+from typing import Any, Callable, Dict, List, Tuple
+
+
+def _update_temperature(data: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    data["temperature"] = payload.get("value", payload)
+
+def _update_humidity(data: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    data["humidity"] = payload.get("value", payload)
+
+def _update_motion(data: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    data["motion_detected"] = payload.get("detected", False)
+
+def _update_light(data: Dict[str, Any], payload: Dict[str, Any]) -> None:
+    data.update(payload)
+
+# メトリクス名 -> デバイスデータの更新関数
+_METRIC_HANDLERS: Dict[str, Callable[[Dict[str, Any], Dict[str, Any]], None]] = {
+    "temperature": _update_temperature,
+    "humidity": _update_humidity,
+    "motion": _update_motion,
+    "light": _update_light,
+}
+
+
+def apply_metric(data: Dict[str, Any], metric: str, payload: Dict[str, Any]) -> None:
+    """メトリクスをデバイスデータに反映（該当なしの場合はペイロードをそのまま格納）"""
+    handler = _METRIC_HANDLERS.get(metric)
+    if handler is not None:
+        handler(data, payload)
+    else:
+        data[metric] = payload
+
+
+def triggered_rules(rules: Tuple[Dict[str, Any], ...], payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """変換済みの条件を評価し、成立したルールを返す"""
+    return [rule for rule in rules if rule["_cond"](payload)]
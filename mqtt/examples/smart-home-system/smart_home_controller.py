@@ -5,25 +5,74 @@ Smart Home System - MQTT Controller (Python Version)
 """
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.matcher import MQTTMatcher
 import json
+import queue
+import re
+import sys
 import time
 import threading
 import logging
+import operator
 from datetime import datetime
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Callable, Optional, List, Tuple, Union
 from dataclasses import dataclass
+
+import orjson
 from rich.console import Console
 from rich.table import Table
 from rich.live import Live
 from rich.panel import Panel
 
+from _hot import apply_metric, triggered_rules
+
 # ロギング設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 console = Console()
 
-@dataclass
+def _filter_to_regex(topic_filter: str) -> str:
+    """MQTTトピックフィルタを正規表現に変換（先読みなどを使わない単純な形）"""
+    levels = topic_filter.split('/')
+    if levels[-1] == '#':
+        # "a/#" は "a" 自身と "a/..." の両方にマッチ
+        prefix = levels[:-1]
+        suffix = "(?:/.*)?" if prefix else ".*"
+    else:
+        prefix = levels
+        suffix = ""
+    
+    body = "/".join("[^/]*" if level == '+' else re.escape(level) for level in prefix)
+    return body + suffix
+
+# 緊急時プロトコルで送信する固定ペイロード（事前にシリアライズしておく）
+_EMERGENCY_LIGHT_PAYLOAD = orjson.dumps({"state": "on", "brightness": 100})
+_EMERGENCY_PLUG_PAYLOAD = orjson.dumps({"state": "off", "exclude": ["emergency"]})
+
+# 条件式で使用できる比較演算子
+_CONDITION_OPS: Dict[str, Callable[[Any, Any], bool]] = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+}
+
+def _compile_condition(condition: Dict[str, Any]) -> Callable[[Dict[str, Any]], bool]:
+    """{"field", "op", "value", "default"} 形式の条件を判定関数に変換"""
+    op = _CONDITION_OPS.get(condition["op"])
+    if op is None:
+        raise ValueError(f"Unsupported condition operator: {condition['op']}")
+    
+    field, value, default = condition["field"], condition["value"], condition.get("default")
+    return lambda data: op(data.get(field, default), value)
+
+# dataclassのslots引数はPython 3.10以降のみ対応
+_DATACLASS_SLOTS: Dict[str, Any] = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+@dataclass(**_DATACLASS_SLOTS)
 class Device:
     """スマートデバイスの情報を格納するデータクラス"""
     device_id: str
@@ -40,9 +89,24 @@ class SmartHomeController:
         self.broker_host = broker_host
         self.broker_port = broker_port
         
-        # デバイス管理
-        self.devices: Dict[str, Device] = {}
+        # デバイス管理（監視テーブルを順次走査できるよう属性ごとの並列リストで保持）
+        self._device_index: Dict[str, int] = {}
+        self._device_ids: List[str] = []
+        self._device_types: List[str] = []
+        self._rooms: List[str] = []
+        self._statuses: List[str] = []
+        self._last_seens: List[Optional[float]] = []  # UNIXエポック秒（表示時にのみ整形）
+        self._device_data: List[Dict[str, Any]] = []
         self.automation_rules: List[Dict[str, Any]] = []
+        # trigger_topic -> ルールのリスト（トピックツリーで共通の階層を1回だけ辿る）
+        self._rule_matcher = MQTTMatcher()
+        self._rule_filter_re: Optional[re.Pattern] = None
+        # 具体的なトピック -> マッチするルール（同じトピックが繰り返し届くためキャッシュする）
+        self._topic_rule_cache: Dict[str, Tuple[Dict[str, Any], ...]] = {}
+        self.topic_rule_cache_size = 1024
+        
+        # 監視テーブルの行キャッシュ: デバイスと同じインデックスに ((last_seen, status), 行データ)
+        self._row_cache: List[Optional[Tuple[Tuple[Optional[float], str], List[str]]]] = []
         
         # MQTT設定
         self.client = mqtt.Client(client_id="smart_home_controller")
@@ -52,6 +116,18 @@ class SmartHomeController:
         
         # 接続状態管理
         self.connected = threading.Event()
+        self.running = False
+        
+        # 受信メッセージはキューに積み、ネットワークループとは別スレッドで処理する
+        self._rx_queue: "queue.Queue[Tuple[str, bytes]]" = queue.Queue(maxsize=10000)
+        self._consumer_thread: Optional[threading.Thread] = None
+        
+        # トピック先頭階層ごとのハンドラ
+        self._dispatch = {
+            "home": self.handle_device_message,
+            "devices": self.handle_device_status,
+            "alerts": self.handle_alert_message
+        }
         
         # デフォルトの自動化ルールを追加
         self.setup_default_automation_rules()
@@ -62,11 +138,12 @@ class SmartHomeController:
         motion_rule = {
             "name": "Motion Light Control",
             "trigger_topic": "home/+/motion/detected",
-            "condition": lambda data: data.get("detected", False),
+            "condition": {"field": "detected", "op": "==", "value": True, "default": False},
             "actions": [
                 {
                     "topic_template": "home/{room}/light/command",
-                    "payload": {"state": "on", "brightness": 80}
+                    "payload": {"state": "on", "brightness": 80},
+                    "qos": 0
                 }
             ]
         }
@@ -75,16 +152,55 @@ class SmartHomeController:
         temperature_rule = {
             "name": "Temperature Control",
             "trigger_topic": "home/+/temperature/value",
-            "condition": lambda data: data.get("temperature", 0) > 28,
+            "condition": {"field": "temperature", "op": ">", "value": 28, "default": 0},
             "actions": [
                 {
                     "topic_template": "home/{room}/ac/command",
-                    "payload": {"state": "on", "mode": "cool", "temperature": 24}
+                    "payload": {"state": "on", "mode": "cool", "temperature": 24},
+                    "qos": 0
                 }
             ]
         }
         
         self.automation_rules.extend([motion_rule, temperature_rule])
+        self.rebuild_rule_index()
+    
+    def rebuild_rule_index(self):
+        """自動化ルールのマッチャーを再構築（ルール変更時に呼び出す）"""
+        # 同じフィルタに複数ルールを登録できるようリストで保持
+        self._rule_matcher = MQTTMatcher()
+        for rule in self.automation_rules:
+            # 宣言的な条件は登録時に1回だけ判定関数に変換
+            rule["_cond"] = _compile_condition(rule["condition"])
+            for action in rule["actions"]:
+                action["_payload_bytes"] = orjson.dumps(action["payload"])
+            try:
+                self._rule_matcher[rule["trigger_topic"]].append(rule)
+            except KeyError:
+                self._rule_matcher[rule["trigger_topic"]] = [rule]
+        
+        # どのルールにもマッチしないトピックを1回の正規表現（Cエンジン）で除外するための事前フィルタ
+        filters = {rule["trigger_topic"] for rule in self.automation_rules}
+        self._rule_filter_re = (
+            re.compile("|".join(f"(?:{_filter_to_regex(f)})" for f in sorted(filters)))
+            if filters else None
+        )
+        self._topic_rule_cache.clear()
+    
+    def rules_for_topic(self, topic: str) -> Tuple[Dict[str, Any], ...]:
+        """トピックにマッチするルールを取得（結果をキャッシュ）"""
+        rules = self._topic_rule_cache.get(topic)
+        if rules is None:
+            if self._rule_filter_re is None or not self._rule_filter_re.fullmatch(topic):
+                rules = ()
+            else:
+                rules = tuple(rule for matched in self._rule_matcher.iter_match(topic) for rule in matched)
+            
+            # 上限に達したら最も古いエントリを削除
+            if len(self._topic_rule_cache) >= self.topic_rule_cache_size:
+                del self._topic_rule_cache[next(iter(self._topic_rule_cache))]
+            self._topic_rule_cache[topic] = rules
+        return rules
     
     def on_connect(self, client, userdata, flags, rc):
         """MQTT接続時のコールバック"""
@@ -99,82 +215,127 @@ class SmartHomeController:
                 ("alerts/+/+", 1),  # アラート
             ]
             
-            for topic, qos in topics:
-                client.subscribe(topic, qos)
+            # 全フィルタを1つのSUBSCRIBEパケットでまとめて購読
+            client.subscribe(topics)
+            for topic, _ in topics:
                 logger.info(f"📡 Subscribed to: {topic}")
         else:
             logger.error(f"❌ Failed to connect: {rc}")
     
     def on_message(self, client, userdata, msg):
-        """メッセージ受信時のコールバック"""
+        """メッセージ受信時のコールバック（キューに積むだけで即座に戻る）"""
+        # 停止処理中は新しいメッセージを受け付けない（受信済みの分だけ処理して終了する）
+        if not self.running:
+            return
+        try:
+            self._rx_queue.put_nowait((msg.topic, msg.payload))
+        except queue.Full:
+            logger.warning(f"Receive queue full, dropping message: {msg.topic}")
+    
+    def _consume(self):
+        """受信キューからメッセージを取り出して処理"""
+        while self.running or not self._rx_queue.empty():
+            try:
+                topic, raw_payload = self._rx_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.process_message(topic, raw_payload)
+    
+    def _start_consumer(self):
+        """処理スレッドを起動（起動済みなら何もしない）"""
+        self.running = True
+        if self._consumer_thread is None or not self._consumer_thread.is_alive():
+            self._consumer_thread = threading.Thread(target=self._consume, daemon=True)
+            self._consumer_thread.start()
+    
+    def _stop_consumer(self):
+        """受信済みのメッセージを処理し終えてから処理スレッドを停止"""
+        self.running = False
+        if self._consumer_thread is not None:
+            self._consumer_thread.join(timeout=5)
+            self._consumer_thread = None
+    
+    def process_message(self, topic: str, raw_payload: bytes):
+        """メッセージ処理"""
         try:
-            topic = msg.topic
-            payload = json.loads(msg.payload.decode())
+            payload = orjson.loads(raw_payload)  # bytesを直接パース（decode不要）
             
             logger.debug(f"📨 Received: {topic} - {payload}")
             
-            # トピックをパースしてデバイス情報を抽出
-            topic_parts = topic.split('/')
+            # トピックを1回だけ分割し、以降の処理で使い回す
+            topic_parts = tuple(topic.split('/'))
             
-            if topic.startswith("home/"):
-                self.handle_device_message(topic_parts, payload)
-            elif topic.startswith("devices/"):
-                self.handle_device_status(topic_parts, payload)
-            elif topic.startswith("alerts/"):
-                self.handle_alert_message(topic_parts, payload)
+            handler = self._dispatch.get(topic_parts[0])
+            if handler:
+                handler(topic_parts, payload)
                 
             # 自動化ルールをチェック
-            self.check_automation_rules(topic, payload)
+            self.check_automation_rules(topic, topic_parts, payload)
             
-        except json.JSONDecodeError:
-            logger.warning(f"Invalid JSON in message: {msg.payload}")
+        except (orjson.JSONDecodeError, json.JSONDecodeError):
+            logger.warning(f"Invalid JSON in message: {raw_payload}")
         except Exception as e:
             logger.error(f"Error processing message: {e}")
     
-    def handle_device_message(self, topic_parts: List[str], payload: Dict[str, Any]):
+    def handle_device_message(self, topic_parts: Tuple[str, ...], payload: Dict[str, Any]):
         """デバイスからのメッセージを処理"""
         if len(topic_parts) >= 4:
             _, room, device_type, metric = topic_parts[:4]
             device_id = f"{room}_{device_type}"
             
             # デバイス情報を更新
-            if device_id not in self.devices:
-                self.devices[device_id] = Device(
-                    device_id=device_id,
-                    device_type=device_type,
-                    room=room
-                )
-            
-            device = self.devices[device_id]
-            device.last_seen = datetime.now()
-            device.status = "online"
-            
-            if device.data is None:
-                device.data = {}
+            index = self._device_index.get(device_id)
+            if index is None:
+                index = self._add_device(device_id, device_type, room)
             
             # メトリクス別の処理
-            if metric == "temperature":
-                device.data["temperature"] = payload.get("value", payload)
-            elif metric == "humidity":
-                device.data["humidity"] = payload.get("value", payload)
-            elif metric == "motion":
-                device.data["motion_detected"] = payload.get("detected", False)
-            elif metric == "light":
-                device.data.update(payload)
-            else:
-                device.data[metric] = payload
+            apply_metric(self._device_data[index], metric, payload)
+            self._statuses[index] = "online"
+            
+            # 監視テーブルの行キャッシュのキーになるため、更新完了の印として最後に書き込む
+            self._last_seens[index] = time.time()
+    
+    def _add_device(self, device_id: str, device_type: str, room: str) -> int:
+        """新しいデバイスを登録してインデックスを返す"""
+        # 監視側はzipで走査するため、インデックスを公開する前に全リストへ追加しておく
+        index = len(self._device_ids)
+        self._row_cache.append(None)
+        self._device_ids.append(device_id)
+        self._device_types.append(device_type)
+        self._rooms.append(room)
+        self._statuses.append("unknown")
+        self._last_seens.append(None)
+        self._device_data.append({})
+        self._device_index[device_id] = index
+        return index
     
-    def handle_device_status(self, topic_parts: List[str], payload: Dict[str, Any]):
+    def get_device(self, device_id: str) -> Optional[Device]:
+        """デバイス情報をDeviceとして取得"""
+        index = self._device_index.get(device_id)
+        if index is None:
+            return None
+        last_seen = self._last_seens[index]
+        return Device(
+            device_id=self._device_ids[index],
+            device_type=self._device_types[index],
+            room=self._rooms[index],
+            status=self._statuses[index],
+            last_seen=datetime.fromtimestamp(last_seen) if last_seen is not None else None,
+            data=self._device_data[index] or None
+        )
+    
+    def handle_device_status(self, topic_parts: Tuple[str, ...], payload: Dict[str, Any]):
         """デバイスステータス更新を処理"""
         if len(topic_parts) >= 3:
             device_id = topic_parts[1]
             status = payload.get("status", "unknown")
             
-            if device_id in self.devices:
-                self.devices[device_id].status = status
+            index = self._device_index.get(device_id)
+            if index is not None:
+                self._statuses[index] = status
                 logger.info(f"🔄 Device {device_id} status: {status}")
     
-    def handle_alert_message(self, topic_parts: List[str], payload: Dict[str, Any]):
+    def handle_alert_message(self, topic_parts: Tuple[str, ...], payload: Dict[str, Any]):
         """アラートメッセージを処理"""
         alert_type = topic_parts[1] if len(topic_parts) > 1 else "unknown"
         logger.warning(f"🚨 Alert [{alert_type}]: {payload}")
@@ -185,41 +346,24 @@ class SmartHomeController:
         elif alert_type == "security":
             self.trigger_emergency_protocol("security")
     
-    def check_automation_rules(self, topic: str, payload: Dict[str, Any]):
+    def check_automation_rules(self, topic: str, topic_parts: Tuple[str, ...], payload: Dict[str, Any]):
         """自動化ルールをチェックして実行"""
-        for rule in self.automation_rules:
-            if self.topic_matches_pattern(topic, rule["trigger_topic"]):
-                if rule["condition"](payload):
-                    logger.info(f"🤖 Executing automation rule: {rule['name']}")
-                    self.execute_rule_actions(rule["actions"], topic, payload)
+        for rule in triggered_rules(self.rules_for_topic(topic), payload):
+            logger.info(f"🤖 Executing automation rule: {rule['name']}")
+            self.execute_rule_actions(rule["actions"], topic_parts, payload)
     
-    def topic_matches_pattern(self, topic: str, pattern: str) -> bool:
-        """トピックがパターンにマッチするかチェック"""
-        topic_parts = topic.split('/')
-        pattern_parts = pattern.split('/')
-        
-        if len(topic_parts) != len(pattern_parts):
-            return False
-        
-        for t, p in zip(topic_parts, pattern_parts):
-            if p != '+' and p != '#' and p != t:
-                return False
-        
-        return True
-    
-    def execute_rule_actions(self, actions: List[Dict[str, Any]], trigger_topic: str, trigger_payload: Dict[str, Any]):
+    def execute_rule_actions(self, actions: List[Dict[str, Any]], topic_parts: Tuple[str, ...],
+                             trigger_payload: Dict[str, Any]):
         """自動化ルールのアクションを実行"""
         # トリガートピックから部屋を抽出
-        topic_parts = trigger_topic.split('/')
         room = topic_parts[1] if len(topic_parts) > 1 else "unknown"
         
         for action in actions:
             try:
                 # トピックテンプレートの変数を置換
                 topic = action["topic_template"].replace("{room}", room)
-                payload = json.dumps(action["payload"])
-                
-                result = self.client.publish(topic, payload, qos=1)
+                # センサーイベント駆動の制御コマンドは既定でQoS 0（緊急時プロトコルはQoS 1のまま）
+                result = self.client.publish(topic, action["_payload_bytes"], qos=action.get("qos", 0))
                 if result.rc == mqtt.MQTT_ERR_SUCCESS:
                     logger.info(f"✅ Automation action sent: {topic}")
                 else:
@@ -233,26 +377,22 @@ class SmartHomeController:
         logger.critical(f"🚨 EMERGENCY PROTOCOL ACTIVATED: {alert_type}")
         
         if alert_type == "fire":
-            # 全照明を点灯
-            for device in self.devices.values():
-                if device.device_type == "light":
-                    topic = f"home/{device.room}/light/command"
-                    payload = json.dumps({"state": "on", "brightness": 100})
-                    self.client.publish(topic, payload, qos=1)
+            # 全照明を点灯（デバイスごとではなく一斉送信で1回だけ配信）
+            self.publish_broadcast_command("light", _EMERGENCY_LIGHT_PAYLOAD)
             
             # 緊急用電源以外を停止
-            self.publish_broadcast_command("plug", {"state": "off", "exclude": ["emergency"]})
+            self.publish_broadcast_command("plug", _EMERGENCY_PLUG_PAYLOAD)
             
         elif alert_type == "security":
             # 全ライトを点灯（防犯対策）
-            self.publish_broadcast_command("light", {"state": "on", "brightness": 100})
+            self.publish_broadcast_command("light", _EMERGENCY_LIGHT_PAYLOAD)
     
-    def publish_broadcast_command(self, device_type: str, command: Dict[str, Any]):
-        """特定デバイスタイプに一斉コマンド送信"""
+    def publish_broadcast_command(self, device_type: str, command: Union[Dict[str, Any], bytes]):
+        """特定デバイスタイプに一斉コマンド送信（シリアライズ済みのbytesも可）"""
         topic = f"broadcast/{device_type}/command"
-        payload = json.dumps(command)
+        payload = command if isinstance(command, bytes) else orjson.dumps(command)
         self.client.publish(topic, payload, qos=1)
-        logger.info(f"📢 Broadcast command sent to {device_type}: {command}")
+        logger.info(f"📢 Broadcast command sent to {device_type}: {payload.decode()}")
     
     def on_disconnect(self, client, userdata, rc):
         """MQTT切断時のコールバック"""
@@ -265,6 +405,9 @@ class SmartHomeController:
     def connect(self) -> bool:
         """ブローカーに接続"""
         try:
+            # 接続直後に届くメッセージに備えて先に処理スレッドを起動
+            self._start_consumer()
+            
             self.client.connect(self.broker_host, self.broker_port, 60)
             self.client.loop_start()
             
@@ -272,13 +415,18 @@ class SmartHomeController:
                 return True
             else:
                 logger.error("Connection timeout")
-                return False
         except Exception as e:
             logger.error(f"Connection failed: {e}")
-            return False
+        
+        self.client.loop_stop()
+        self._stop_consumer()
+        return False
     
     def disconnect(self):
         """ブローカーから切断"""
+        # 受信済みのメッセージ（緊急時プロトコルの送信を含む）を処理してから切断
+        self._stop_consumer()
+        
         self.client.loop_stop()
         self.client.disconnect()
     
@@ -293,18 +441,32 @@ class SmartHomeController:
         table.add_column("Last Seen", style="blue")
         table.add_column("Data", style="white")
         
-        for device in self.devices.values():
-            last_seen = device.last_seen.strftime("%H:%M:%S") if device.last_seen else "Never"
-            data_str = json.dumps(device.data, indent=None) if device.data else "No data"
+        row_cache = self._row_cache
+        columns = zip(self._device_ids, self._device_types, self._rooms,
+                      self._statuses, self._last_seens, self._device_data)
+        for index, (device_id, device_type, room, status, last_seen, data) in enumerate(columns):
+            # 前回の描画から更新のないデバイスはキャッシュした行を再利用
+            key = (last_seen, status)
+            cached = row_cache[index]
+            if cached and cached[0] == key:
+                row = cached[1]
+            else:
+                last_seen_str = (
+                    datetime.fromtimestamp(last_seen).strftime("%H:%M:%S") if last_seen is not None else "Never"
+                )
+                data_str = json.dumps(data, indent=None) if data else "No data"
+                
+                row = [
+                    device_id,
+                    device_type,
+                    room,
+                    status,
+                    last_seen_str,
+                    data_str[:50] + "..." if len(data_str) > 50 else data_str
+                ]
+                row_cache[index] = (key, row)
             
-            table.add_row(
-                device.device_id,
-                device.device_type,
-                device.room,
-                device.status,
-                last_seen,
-                data_str[:50] + "..." if len(data_str) > 50 else data_str
-            )
+            table.add_row(*row)
         
         return table
     
@@ -330,7 +492,7 @@ class SmartHomeController:
         
         for device in test_devices:
             topic = f"home/{device['room']}/{device['type']}/value"
-            payload = json.dumps(device['data'])
+            payload = orjson.dumps(device['data'])
             self.client.publish(topic, payload, qos=1)
             logger.info(f"📤 Test data sent: {topic}")
 
@@ -339,7 +501,7 @@ def main():
     console.print(Panel.fit(
         "🏠 Smart Home System Controller\n\n"
         "Language: Python 3\n"
-        "Library: paho-mqtt\n"
+        "Library: paho-mqtt, orjson\n"
         "Features: Device Management, Automation, Emergency Protocols",
         title="MQTT Smart Home Controller",
         border_style="blue"
@@ -7,6 +7,7 @@ MQTT基本接続デモ - Python版
 import paho.mqtt.client as mqtt
 import time
 import sys
+import threading
 from rich.console import Console
 from rich.panel import Panel
 from rich.text import Text
@@ -21,13 +22,16 @@ class BasicMQTTClient:
         self.broker_port = broker_port
         self.client = None
         self.is_connected = False
+        self._connected_evt = threading.Event()
+        self._client_id_str = None
         
     def on_connect(self, client, userdata, flags, rc):
         """接続時のコールバック"""
         if rc == 0:
             self.is_connected = True
+            self._connected_evt.set()
             console.print("✅ Connected to MQTT broker successfully!", style="bold green")
-            console.print(f"   Client ID: {client._client_id.decode()}", style="dim")
+            console.print(f"   Client ID: {self._client_id_str}", style="dim")
             console.print(f"   Broker: {self.broker_host}:{self.broker_port}", style="dim")
             console.print(f"   Session Present: {flags['session_present']}", style="dim")
         else:
@@ -37,6 +41,7 @@ class BasicMQTTClient:
     def on_disconnect(self, client, userdata, rc):
         """切断時のコールバック"""
         self.is_connected = False
+        self._connected_evt.clear()
         if rc != 0:
             console.print("⚠️  Unexpected disconnection", style="bold yellow")
         else:
@@ -76,7 +81,8 @@ class BasicMQTTClient:
         console.print(f"🔗 Connecting to MQTT broker: {self.broker_host}:{self.broker_port}", 
                      style="bold blue")
         
-        # MQTTクライアントの作成
+        # MQTTクライアントの作成（クライアントIDは文字列のまま保持）
+        self._client_id_str = client_id
         self.client = mqtt.Client(client_id=client_id)
         
         # コールバック設定
@@ -89,14 +95,8 @@ class BasicMQTTClient:
             self.client.connect(self.broker_host, self.broker_port, 60)
             self.client.loop_start()
             
-            # 接続完了まで待機
-            timeout = 10
-            start_time = time.time()
-            
-            while not self.is_connected and (time.time() - start_time) < timeout:
-                time.sleep(0.1)
-                
-            if not self.is_connected:
+            # 接続完了まで待機（on_connectでセットされるイベントを待つ）
+            if not self._connected_evt.wait(timeout=10):
                 raise Exception("Connection timeout")
                 
             return True
@@ -116,7 +116,7 @@ class BasicMQTTClient:
         """接続状態を取得"""
         return {
             "connected": self.is_connected,
-            "client_id": self.client._client_id.decode() if self.client else None,
+            "client_id": self._client_id_str,
             "broker": f"{self.broker_host}:{self.broker_port}",
             "transport": "TCP"
         }